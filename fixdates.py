@@ -1,80 +1,305 @@
 #!/usr/bin/python3
 
 import argparse
-from os import listdir, path, utime, remove
+from os import scandir, path, utime, remove, fsencode, fstat, stat, link, cpu_count, environ
 import subprocess
+from errno import EXDEV, EPERM, EOPNOTSUPP
+import mmap
+import json
+import sqlite3
 from datetime import datetime
 from pathlib import Path
-from shutil import move
+from shutil import move, which
 import logging
 import traceback
 from hashlib import md5
+try:
+    from blake3 import blake3
+except ImportError:
+    # Optional, much faster than MD5 for duplicate detection
+    blake3 = None
+from itertools import islice
+from threading import Lock
+from queue import Queue
+from collections import deque
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Number of files handed to exiftool per -execute
+BATCH_SIZE = 1000
 
-def list(directory: str) -> list:
-    files = []
-    for item in listdir(directory):
-        if path.isdir(path.join(directory, item)):
-            files += list(path.join(directory, item))
-        else:
-            files.append(path.join(directory, item))
-    return files
-
-def get_exif(exiftool, file) -> dict:
-    ret_dict = {}
-    exiftool_proc = subprocess.Popen([exiftool, '-d', '%Y:%m:%d %H:%M:%S', file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = exiftool_proc.communicate()
-    if exiftool_proc.returncode == 0:
-        for line in out.decode().strip().split('\n'):
-            line = line.strip().split(':', 1)
-            ret_dict.update({line[0].strip():line[1].strip()})
-        return ret_dict
-    else:
+# Format exiftool is asked to print dates in, see parse_exif_date
+DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+# Zero-padded month directory names, indexed by month number
+_MONTH_DIRS = [f'{month:02d}' for month in range(13)]
+
+CACHE_PATH = path.join(environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache'), 'fixdates', 'exif.sqlite')
+# Bump when the cache table layout changes
+_CACHE_VERSION = 2
+_cache_lock = Lock()
+
+# Serialise the exists check and the move per destination, striped to keep the lock count fixed
+_dest_locks = [Lock() for _ in range(64)]
+
+# Destination directories already created this run
+_made_dirs = set()
+
+
+def _is_dir(entry) -> bool:
+    # Like path.isdir: follow symlinks, and treat a target that cannot be stat'd (ELOOP, EACCES) as not a directory
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+def iter_files(directory: str) -> Iterator[str]:
+    # Walk with an explicit stack rather than nested generators, so each path is
+    # yielded straight to the caller instead of through one frame per directory level
+    directories = [directory]
+    while directories:
+        with scandir(directories.pop()) as entries:
+            for entry in entries:
+                if _is_dir(entry):
+                    directories.append(entry.path)
+                else:
+                    yield entry.path
+
+def start_exiftool(exiftool) -> subprocess.Popen:
+    logger.debug('Starting \'%s\' in stay_open mode', exiftool)
+    return subprocess.Popen([exiftool, '-stay_open', 'True', '-@', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+def stop_exiftool(exiftool_proc):
+    logger.debug('Stopping exiftool')
+    exiftool_proc.stdin.write(b'-stay_open\nFalse\n')
+    exiftool_proc.stdin.flush()
+    exiftool_proc.wait()
+
+def restart_exiftool(exiftool_proc) -> subprocess.Popen:
+    logger.warning('Restarting exiftool')
+    exiftool_proc.kill()
+    exiftool_proc.wait()
+    return start_exiftool(exiftool_proc.args[0])
+
+def open_cache(cache_path) -> sqlite3.Connection:
+    logger.debug('Opening EXIF cache \'%s\'', cache_path)
+    try:
+        Path(cache_path).parent.mkdir(exist_ok=True, parents=True)
+        # Shared with the worker threads, access is serialised by _cache_lock
+        cache = sqlite3.connect(cache_path, check_same_thread=False)
+        if cache.execute('PRAGMA user_version').fetchone()[0] != _CACHE_VERSION:
+            # Written with an older layout, the entries cannot be validated so start afresh
+            cache.execute('DROP TABLE IF EXISTS exif')
+            cache.execute(f'PRAGMA user_version = {_CACHE_VERSION}')
+        cache.execute('CREATE TABLE IF NOT EXISTS exif (path TEXT PRIMARY KEY, mtime_ns INTEGER, ctime_ns INTEGER, size INTEGER, tags TEXT)')
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Could not open EXIF cache \'%s\' (%s), continuing without it', cache_path, e)
         return None
+    return cache
+
+def cached_exif(cache, file) -> dict:
+    try:
+        file_stat = stat(file)
+    except OSError:
+        # Dangling symlink or unreadable entry, leave it for exiftool to report
+        return None
+    with _cache_lock:
+        row = cache.execute('SELECT tags FROM exif WHERE path = ? AND mtime_ns = ? AND ctime_ns = ? AND size = ?', (path.abspath(file), file_stat.st_mtime_ns, file_stat.st_ctime_ns, file_stat.st_size)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def cache_exif(cache, file, exif):
+    try:
+        file_stat = stat(file)
+    except OSError:
+        return
+    with _cache_lock:
+        cache.execute('INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?, ?)', (path.abspath(file), file_stat.st_mtime_ns, file_stat.st_ctime_ns, file_stat.st_size, json.dumps(exif)))
+
+def uncache_exif(cache, file):
+    with _cache_lock:
+        cache.execute('DELETE FROM exif WHERE path = ?', (path.abspath(file),))
+
+def read_response(exiftool_proc) -> bytes:
+    # stdout is unbuffered, so readline() would cost a read(2) per byte; read in blocks up to the sentinel instead
+    output = bytearray()
+    while not output.endswith(b'{ready}\n'):
+        chunk = exiftool_proc.stdout.read(65536)
+        if not chunk:
+            raise EOFError('exiftool exited unexpectedly')
+        output += chunk
+    return bytes(output[:-len(b'{ready}\n')])
+
+def get_exif(exiftool_proc, files, cache=None, refresh=False) -> dict:
+    exif = {}
+    if cache is not None and not refresh:
+        for file in files:
+            tags = cached_exif(cache, file)
+            if tags is not None:
+                exif[file] = tags
+        logger.debug('%d of %d files found in EXIF cache', len(exif), len(files))
+    missing = []
+    for file in files:
+        if file in exif:
+            continue
+        # Paths go one per line into exiftool's argument file, so one with a line break would be split into
+        # extra arguments (which can be tag writes), and a leading '#' or '-' reads as a comment or option
+        if '\n' in file or '\r' in file or file.startswith(('#', '-')) or file != file.strip():
+            logger.error('%r cannot be passed to exiftool safely, skipping', file)
+            continue
+        missing.append(file)
+    if not missing:
+        return exif
+    # -fast skips scanning for JPEG trailers; -fast2 would also stop at the QuickTime mdat atom and miss dates in some videos
+    exiftool_args = ['-j', '-fast', '-d', DATE_FORMAT, '-CreateDate', '-DateCreated'] + missing + ['-execute']
+    exiftool_proc.stdin.write(b'\n'.join(fsencode(arg) for arg in exiftool_args) + b'\n')
+    exiftool_proc.stdin.flush()
+    output = read_response(exiftool_proc)
+    # Errors go to stderr, so files exiftool cannot read are missing from the output
+    if not output.strip():
+        return exif
+    for item in json.loads(output):
+        file = item.pop('SourceFile')
+        exif[file] = item
+        if cache is not None:
+            cache_exif(cache, file, item)
+    return exif
     
+def parse_exif_date(date: str) -> datetime:
+    # Fixed-width DATE_FORMAT, so slice it rather than going through strptime
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]), int(date[14:16]), int(date[17:19]))
+
 def exif_to_date(exif):
-    known_keys = ['Create Date', 'Date Created']
+    known_keys = ['CreateDate', 'DateCreated']
     for key in known_keys:
-        if key in exif.keys():
-            logger.debug('Found \'%s\' in EXIF, using it')
-            return datetime.strptime(exif['Create Date'], '%Y:%m:%d %H:%M:%S')
+        if key in exif:
+            logger.debug('Found \'%s\' in EXIF, using it', key)
+            return parse_exif_date(exif[key])
     logger.error('No known creation dates in EXIF, giving up')
 
-def sort_file(file, exif, output_dir):
-    exif_date = exif_to_date(exif)
-    if exif_date is None:
-        return
+def file_hash(file) -> str:
+    if blake3 is not None:
+        return blake3(max_threads=blake3.AUTO).update_mmap(file).hexdigest()
+    with open(file, 'rb') as f:
+        # Empty files cannot be mapped
+        if fstat(f.fileno()).st_size == 0:
+            return md5().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            return md5(mm).hexdigest()
+
+def sort_file(file, exif_date, output_dir):
     logger.debug('EXIF has date %s', exif_date)
-    dest_dir = path.join(output_dir, str(exif_date.year), str(exif_date.month).rjust(2, '0'))
-    logger.debug('Creating \'%s\'', dest_dir)
-    Path(dest_dir).mkdir(exist_ok=True, parents=True)
-    logger.info('Moving \'%s\' -> \'%s\'', file, path.join(dest_dir, path.basename(file)))
-    if path.exists(path.join(dest_dir, path.basename(file))):
-        logger.error('\'%s\' already exists, will not move', path.join(dest_dir, path.basename(file)))
-        if args.md5:
-            logger.debug('Calculating MD5 of \'%s\' as requested', file)
-            with open(file, 'rb') as source_file:
-                source_md5 = md5(source_file.read()).hexdigest()
-            logger.debug('Calculating MD5 of \'%s\' as requested', path.join(dest_dir, path.basename(file)))
-            with open(path.join(dest_dir, path.basename(file)), 'rb') as target_file:
-                target_md5 = md5(target_file.read()).hexdigest()
-            logger.info('Source: %s, Destination: %s', source_md5, target_md5)
-            if args.delete_matching:
-                if source_md5 == target_md5:
-                    logger.warning('Source and target MD5s match, deleting \'%s\'', file)
-                    remove(file)
-                else:
-                    logger.info('MD5s do not match, leaving source file alone')
- 
-        return
-    move(file, path.join(dest_dir, path.basename(file)))
-    update_file(path.join(dest_dir, path.basename(file)), exif_date)
+    dest_dir = path.join(output_dir, str(exif_date.year), _MONTH_DIRS[exif_date.month])
+    # Unlocked on purpose: two workers may both create the same new directory, which exist_ok=True makes harmless
+    if dest_dir not in _made_dirs:
+        logger.debug('Creating \'%s\'', dest_dir)
+        Path(dest_dir).mkdir(exist_ok=True, parents=True)
+        _made_dirs.add(dest_dir)
+    dest = path.join(dest_dir, path.basename(file))
+    logger.info('Moving \'%s\' -> \'%s\'', file, dest)
+    # Files from different folders can share a name, so the check and the move must not interleave
+    with _dest_locks[hash(dest) % len(_dest_locks)]:
+        if path.exists(dest):
+            if path.samefile(file, dest):
+                logger.debug('\'%s\' is already in place', file)
+                return
+            logger.error('\'%s\' already exists, will not move', dest)
+            if args.md5:
+                if path.getsize(file) != path.getsize(dest):
+                    logger.info('Source and destination sizes differ, skipping hash and leaving source file alone')
+                    return
+                logger.debug('Calculating hash of \'%s\' as requested', file)
+                source_hash = file_hash(file)
+                logger.debug('Calculating hash of \'%s\' as requested', dest)
+                target_hash = file_hash(dest)
+                logger.info('Source: %s, Destination: %s', source_hash, target_hash)
+                if args.delete_matching:
+                    if source_hash == target_hash:
+                        logger.warning('Source and target hashes match, deleting \'%s\'', file)
+                        remove(file)
+                    else:
+                        logger.info('Hashes do not match, leaving source file alone')
+
+            return
+        # Hard link then unlink rather than rename, so an existing destination is never overwritten
+        try:
+            link(file, dest)
+        except FileExistsError:
+            logger.error('\'%s\' already exists, will not move', dest)
+            return
+        except OSError as e:
+            if e.errno not in (EXDEV, EPERM, EOPNOTSUPP):
+                raise
+            # Output directory is on another filesystem, or one without hard links, fall back to copy and delete
+            move(file, dest)
+        else:
+            remove(file)
+    update_file(dest, exif_date)
+    return dest
     
 def update_file(file, timestamp):
     logger.info('Updating timestamps on \'%s\' to \'%s\'',file, timestamp)
-    utime((file), (timestamp.timestamp(), timestamp.timestamp()))
+    # datetime only has microsecond precision, so round there before scaling to avoid float noise
+    ts = round(timestamp.timestamp() * 1_000_000) * 1_000
+    utime(file, ns=(ts, ts))
+
+def process_file(file, exif, cache=None):
+    logger.info('Processing file: \'%s\'', file)
+    if exif is None:
+        logger.warning('\'%s\' has no EXIF data. Will not process further', file)
+        return
+    try:
+        exif_date = exif_to_date(exif)
+        if exif_date is None:
+            return
+        if args.sort:
+            dest = sort_file(file, exif_date, args.output)
+        else:
+            update_file(file, exif_date)
+            dest = file
+        # Moving and touching the file invalidates its cache entry, so record it again
+        if cache is not None and dest is not None:
+            if dest != file:
+                uncache_exif(cache, file)
+            cache_exif(cache, dest, exif)
+    except Exception:
+        logger.error(traceback.format_exc())
+
+def lookup_batch(exiftool_procs, batch, cache=None, refresh=False) -> dict:
+    exiftool_proc = exiftool_procs.get()
+    try:
+        try:
+            return get_exif(exiftool_proc, batch, cache, refresh)
+        except (OSError, EOFError):
+            logger.error('exiftool failed reading a batch of %d files, retrying them one at a time', len(batch))
+            exiftool_proc = restart_exiftool(exiftool_proc)
+        # A single bad file should only cost itself, not the rest of its batch
+        exif = {}
+        for file in batch:
+            try:
+                exif.update(get_exif(exiftool_proc, [file], cache, refresh))
+            except (OSError, EOFError):
+                logger.error('exiftool failed reading \'%s\'', file)
+                exiftool_proc = restart_exiftool(exiftool_proc)
+        return exif
+    finally:
+        exiftool_procs.put(exiftool_proc)
+
+def dispatch_next(executor, pending, processing, cache=None) -> list:
+    # Let the workers finish the current batch before handing them the next one
+    for future in processing:
+        future.result()
+    batch, lookup = pending.popleft()
+    exif = lookup.result()
+    processing = [executor.submit(process_file, file, exif.get(file), cache) for file in batch]
+    if cache is not None:
+        with _cache_lock:
+            cache.commit()
+    return processing
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format="[%(asctime)s] %(levelname)s %(message)s")
@@ -82,10 +307,20 @@ if __name__ == '__main__':
     parser.add_argument('directory', type=str, nargs='+', help='Directory containing source images.')
     parser.add_argument('-s', '--sort', action='store_true', help='Sort images into year/month subdirectories.')
     parser.add_argument('-o', '--output', type=str, help='Output directory (for use with --sort)')
-    parser.add_argument('-m', '--md5', action='store_true', help='Calculate MD5s of matching filenames.')
-    parser.add_argument('--delete-matching', action='store_true', help='Delete file if a matching (by name & MD5) file is found in the destination')
+    parser.add_argument('-m', '--md5', action='store_true', help='Calculate hashes (BLAKE3 if installed, otherwise MD5) of matching filenames.')
+    parser.add_argument('--delete-matching', action='store_true', help='Delete file if a matching (by name & hash) file is found in the destination')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count() or 1, help='Number of files to process in parallel (default: number of CPUs)')
+    parser.add_argument('--exiftool-procs', type=int, default=1, help='Number of exiftool processes to read EXIF data with (default: 1)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the EXIF cache.')
+    parser.add_argument('--refresh-cache', action='store_true', help='Ignore cached EXIF data and re-read every file with exiftool.')
+    parser.add_argument('--cache', type=str, default=CACHE_PATH, help=f'EXIF cache location (default: {CACHE_PATH})')
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.exiftool_procs < 1:
+        parser.error('--exiftool-procs must be at least 1')
+
     if args.delete_matching and not args.md5:
         parser.error('--md5 is required for --delete-matching')
     if args.sort:
@@ -95,28 +330,37 @@ if __name__ == '__main__':
         Path(args.output).mkdir(exist_ok=True, parents=True)
     
     logger.debug('Attempting to find \'exiftool\'')
-    which_proc = subprocess.Popen(['which', 'exiftool'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = which_proc.communicate()
-    if which_proc.returncode == 0:
-        exiftool = out.decode().strip()
+    exiftool = which('exiftool')
+    if exiftool is not None:
         logger.info('Found \'exiftool\' at \'%s\'', exiftool)
     else:
         logger.critical('Failed to find \'exiftool\' is it installed?')
         raise FileNotFoundError('Could not find exiftool')
 
-    for dir in args.directory:
-        for file in list(dir):
-            logger.info('Processing file: \'%s\'', file)
-            if get_exif(exiftool, file) is None:
-                logger.warning('\'%s\' has no EXIF data. Will not process further', file)
-                continue
-            if args.sort:
-                try:
-                    sort_file(file, get_exif(exiftool, file), args.output)
-                except Exception:
-                    logger.error(traceback.format_exc())
-            else:
-                try:
-                    update_file(file, exif_to_date(get_exif(exiftool, file)))
-                except Exception:
-                    logger.error(traceback.format_exc())
+    cache = None if args.no_cache else open_cache(args.cache)
+    exiftool_procs = Queue()
+    for _ in range(args.exiftool_procs):
+        exiftool_procs.put(start_exiftool(exiftool))
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.exiftool_procs) as lookups, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            # Keep one lookup per exiftool running ahead of the batch being moved and
+            # touched, so exiftool and the file I/O overlap without reading the whole tree
+            pending = deque()
+            processing = []
+            for dir in args.directory:
+                files = iter_files(dir)
+                while batch := [*islice(files, BATCH_SIZE)]:
+                    pending.append((batch, lookups.submit(lookup_batch, exiftool_procs, batch, cache, args.refresh_cache)))
+                    if len(pending) > args.exiftool_procs:
+                        processing = dispatch_next(executor, pending, processing, cache)
+            while pending:
+                processing = dispatch_next(executor, pending, processing, cache)
+            for future in processing:
+                future.result()
+    finally:
+        while not exiftool_procs.empty():
+            stop_exiftool(exiftool_procs.get())
+        if cache is not None:
+            cache.commit()
+            cache.close()